@@ -1,8 +1,11 @@
 
 import io
+import re
 from datetime import datetime
+import numpy as np
 import pandas as pd
 import streamlit as st
+from scipy.optimize import linear_sum_assignment
 
 st.set_page_config(page_title="Stonebridge Scheduler – First Working Version", layout="wide")
 
@@ -17,23 +20,32 @@ def title_abbrev(site: str) -> str:
         return "SA"
     return site
 
-def to_google_csv(rows):
-    cols = ["Subject","Start Date","Start Time","End Date","End Time","All Day Event","Description","Location"]
-    df = pd.DataFrame(rows, columns=cols)
-    df["All Day Event"] = "True"
-    buf = io.StringIO()
-    df.to_csv(buf, index=False)
+GCAL_COLUMNS = ["Subject","Start Date","Start Time","End Date","End Time","All Day Event","Description","Location"]
+
+def to_google_csv(events_df: pd.DataFrame) -> bytes:
+    buf = io.BytesIO()
+    events_df.reindex(columns=GCAL_COLUMNS, fill_value="").to_csv(buf, index=False)
     return buf.getvalue()
 
-def load_tabular(uploaded_file) -> pd.DataFrame:
-    name = uploaded_file.name.lower()
+def load_tabular(file_bytes: bytes, name: str) -> pd.DataFrame:
+    name = name.lower()
     if name.endswith(".xlsx") or name.endswith(".xls"):
-        return pd.read_excel(uploaded_file, dtype=str)
-    return pd.read_csv(uploaded_file, dtype=str)
+        try:
+            return pd.read_excel(io.BytesIO(file_bytes), dtype=str, engine="calamine", usecols=is_alias_column)
+        except ImportError:
+            return pd.read_excel(io.BytesIO(file_bytes), dtype=str, usecols=is_alias_column)
+    header = pd.read_csv(io.BytesIO(file_bytes), nrows=0).columns
+    usecols = [c for c in header if is_alias_column(c)]
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+        convert = pa_csv.ConvertOptions(column_types={c: pa.string() for c in usecols}, include_columns=usecols, strings_can_be_null=True)
+        return pa_csv.read_csv(io.BytesIO(file_bytes), convert_options=convert).to_pandas()
+    except (ImportError, ValueError):
+        return pd.read_csv(io.BytesIO(file_bytes), dtype=str, usecols=usecols)
 
 def norm_cols(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
-    df.columns = [str(c).strip().lower() for c in df.columns]
+    df.columns = df.columns.astype(str).str.strip().str.lower()
     return df
 
 ALIASES = {
@@ -45,113 +57,204 @@ ALIASES = {
     "language": ["language","lang"],
 }
 
-def pick(low: dict, keys) -> str:
-    for k in keys:
-        v = low.get(k)
-        if v is not None and str(v).strip() != "":
-            return str(v).strip()
-    return ""
-
-def to_iso_date(val: str) -> str:
-    s = (val or "").strip()
-    if len(s) >= 10 and s[4:5] == "-" and s[7:8] == "-":
-        return s[:10]
-    if "/" in s:
-        p = s.split()[0].split("/")
-        if len(p) >= 3:
-            mm = p[0].zfill(2); dd = p[1].zfill(2); yyyy = p[2]
-            if len(yyyy) == 2: yyyy = "20" + yyyy
-            return f"{yyyy}-{mm}-{dd}"
-    try:
-        return pd.to_datetime(s, errors="coerce").strftime("%Y-%m-%d")
-    except Exception:
-        return s[:10]
-
-def normalize_row(row: pd.Series) -> dict:
-    low = {str(k).strip().lower(): row.get(k, "") for k in row.index}
-    site = pick(low, ALIASES["site"])
-    date_raw = pick(low, ALIASES["date"])
-    date = to_iso_date(date_raw)
-    modality = pick(low, ALIASES["modality"])
-    role_guess = pick(low, ALIASES["role"]).lower()
-    provider = pick(low, ALIASES["provider"])
-    language = (pick(low, ALIASES["language"]) or "English").lower()
-
-    if not modality:
-        modality = "Telehealth" if "tele" in (site or "").lower() else "Live"
-
-    if role_guess in ("interviewer","tester","solo"):
-        role = role_guess
-    else:
-        if any(k in role_guess for k in ("tester","lpa","psychometric")):
-            role = "tester"
-        elif any(k in role_guess for k in ("solo","independent")):
-            role = "solo"
-        else:
-            role = "interviewer"
-
-    return {"site": site, "date": date, "modality": modality, "role": role, "provider": provider, "language": language}
-
-SPANISH_SET = {
+ALIAS_COLUMNS = frozenset(c for names in ALIASES.values() for c in names)
+
+def is_alias_column(col) -> bool:
+    return str(col).strip().lower() in ALIAS_COLUMNS
+
+ROLES = ("interviewer","tester","solo")
+_TESTER_ROLE_RE = re.compile("tester|lpa|psychometric")
+_SOLO_ROLE_RE = re.compile("solo|independent")
+
+def _resolve_alias_column(df: pd.DataFrame, aliases) -> pd.Series:
+    out = pd.Series("", index=df.index, dtype=object)
+    for c in reversed([c for c in aliases if c in df.columns]):
+        for i in reversed(np.flatnonzero(df.columns == c)):
+            col = df.iloc[:, i].fillna("").astype(str).str.strip()
+            out = col.where(col != "", out)
+    return out
+
+DATE_FORMATS = ("%m/%d/%Y", "%m/%d/%y")
+_TZ_SUFFIX_RE = re.compile(r"(\d:\d{2}(?::\d{2}(?:\.\d+)?)?(?:\s*[AaPp]\.?[Mm]\.?)?)\s*(?:Z|[A-Z]{3,4})?\s*(?:[+-]\d{2}:?\d{2})?$")
+
+def to_iso_dates(raw: pd.Series) -> pd.Series:
+    iso = raw.str.match(r"^\d{4}-\d{2}-\d{2}")
+    pending = raw[~iso & (raw != "")]
+    token = pending.str.split(n=1).str[0]
+    parsed = pd.to_datetime(token, format=DATE_FORMATS[0], errors="coerce")
+    for fmt in DATE_FORMATS[1:]:
+        todo = parsed.isna()
+        if not todo.any():
+            break
+        parsed = parsed.combine_first(pd.to_datetime(token[todo], format=fmt, errors="coerce"))
+    todo = parsed.isna()
+    if todo.any():
+        local = pending[todo].str.replace(_TZ_SUFFIX_RE, r"\1", regex=True)
+        parsed = parsed.combine_first(pd.to_datetime(local, format="mixed", errors="coerce"))
+    out = parsed.dt.strftime("%Y-%m-%d").reindex(raw.index).fillna("")
+    return pd.Series(np.where(iso, raw.str[:10], out), index=raw.index)
+
+def normalize_roster(df: pd.DataFrame) -> pd.DataFrame:
+    site = _resolve_alias_column(df, ALIASES["site"])
+    date_raw = _resolve_alias_column(df, ALIASES["date"])
+    modality = _resolve_alias_column(df, ALIASES["modality"])
+    role_guess = _resolve_alias_column(df, ALIASES["role"]).str.lower()
+    provider = _resolve_alias_column(df, ALIASES["provider"])
+    language = _resolve_alias_column(df, ALIASES["language"]).str.lower().replace("", "english")
+
+    modality = modality.mask(modality == "", np.where(site.str.lower().str.contains("tele", regex=False), "Telehealth", "Live"))
+
+    codes, labels = pd.factorize(role_guess)
+    labels = pd.Series(labels, dtype=object)
+    label_roles = np.select(
+        [labels.isin(ROLES), labels.str.contains(_TESTER_ROLE_RE), labels.str.contains(_SOLO_ROLE_RE)],
+        [labels.to_numpy(dtype=object), "tester", "solo"],
+        default="interviewer",
+    )
+    role = pd.Categorical.from_codes(pd.Index(ROLES).get_indexer(label_roles)[codes], categories=list(ROLES))
+
+    return pd.DataFrame({"site": site, "date": to_iso_dates(date_raw), "modality": modality, "role": role, "provider": provider, "language": language})
+
+SPANISH_SET = frozenset({
     "cintia martinez","liliana pizana","emma thomae","ben aguilar","cesar villarreal",
     "teresa castano","dr. alvarez-sanders","alvarez-sanders","belinda castillo","noemi martinez"
-}
+})
+
+_SPANISH_RE = re.compile("|".join(sorted(map(re.escape, SPANISH_SET), key=len, reverse=True)))
+_STRICT_PREF_RE = re.compile("lakaii jones|lyn mcdonald")
+
+PREF_MET_SCORE = 4
+
+PREFERRED_PAIRS = (
+    ("lakaii jones", "virginia parker", 5),
+    ("lyn mcdonald", "ed howarth", 5),
+    ("liliana pizana", "emma thomae", 4),
+)
+
+def preference_bits(providers: pd.Series, provider_lc: pd.Series) -> dict:
+    i_bits = np.zeros(len(providers), dtype=np.int64)
+    t_bits = np.zeros(len(providers), dtype=np.int64)
+    for k, (i_key, t_key, _) in enumerate(PREFERRED_PAIRS):
+        i_bits |= provider_lc.str.contains(i_key, regex=False).to_numpy(dtype=np.int64) << k
+        t_bits |= provider_lc.str.contains(t_key, regex=False).to_numpy(dtype=np.int64) << k
+    return dict(zip(providers, zip(i_bits.tolist(), t_bits.tolist())))
+
+def score_matrix(interviewers, testers, langs, pref_bits) -> np.ndarray:
+    lang_i = np.array([langs[n] for n in interviewers], dtype=object)
+    lang_t = np.array([langs[n] for n in testers], dtype=object)
+    scores = (lang_i[:, None] == lang_t[None, :]).astype(np.int8) * 2
+    i_bits = np.array([pref_bits[n][0] for n in interviewers], dtype=np.int64)
+    t_bits = np.array([pref_bits[n][1] for n in testers], dtype=np.int64)
+    if not (np.bitwise_or.reduce(i_bits) & np.bitwise_or.reduce(t_bits)):
+        return scores
+    common = i_bits[:, None] & t_bits[None, :]
+    for k in reversed(range(len(PREFERRED_PAIRS))):
+        scores[(common >> k) & 1 == 1] = PREFERRED_PAIRS[k][2]
+    return scores
+
+def pair_optimal(interviewers, testers, langs, pref_bits, needs_pref):
+    testers = list(dict.fromkeys(testers))
+    pairs = [(i_name, None, -1) for i_name in interviewers]
+    if not interviewers or not testers:
+        return pairs, testers
+    scores = score_matrix(interviewers, testers, langs, pref_bits)
+    strict = np.array([n in needs_pref for n in interviewers])
+    met = (scores >= PREF_MET_SCORE) | ~strict[:, None]
+    weights = scores + met * (int(scores.max()) + 1) * len(interviewers)
+    rows, cols = linear_sum_assignment(weights, maximize=True)
+    for r, c in zip(rows, cols):
+        pairs[r] = (interviewers[r], testers[c], int(scores[r, c]))
+    assigned = set(cols)
+    return pairs, [t for j, t in enumerate(testers) if j not in assigned]
 
-def lang_of(name: str) -> str:
-    if not name:
-        return "english"
-    return "spanish" if any(tok in name.lower() for tok in SPANISH_SET) else "english"
+EVENT_FIELDS = ("kind","site","date","modality","name","partner","score")
 
-def score_pair(i_name: str, t_name: str) -> int:
-    i = (i_name or "").lower()
-    t = (t_name or "").lower()
-    if "lakaii jones" in i and "virginia parker" in t: return 5
-    if "lyn mcdonald" in i and "ed howarth" in t: return 5
-    if "liliana pizana" in i and "emma thomae" in t: return 4
-    if lang_of(i_name) == lang_of(t_name): return 2
-    return 0
+def build_events(ev: pd.DataFrame, site_abbrev: dict) -> pd.DataFrame:
+    kind = ev["kind"].to_numpy(dtype=object)
+    is_pair, is_gap_i, is_gap_t = kind == "pair", kind == "gap_interviewer", kind == "gap_tester"
+    site = ev["site"].astype(object)
+    modality = ev["modality"].astype(object)
+    name = ev["name"].astype(object)
+    prefix = site.map(site_abbrev) + " | "
+    note = pd.Series(np.select([ev["score"] >= 4, ev["score"] == 2], [" Preference satisfied.", " Language-matched."], default=""), index=ev.index)
+    subject = np.select(
+        [is_pair, is_gap_i, is_gap_t],
+        [prefix + "Pairing: " + name + " + " + ev["partner"], prefix + "GAP: " + name + " (no tester)", prefix + "GAP: " + name + " (tester unassigned)"],
+        default=prefix + "SOLO: " + name,
+    )
+    desc = np.select(
+        [is_pair, is_gap_i, is_gap_t],
+        ["Dyad pairing for " + ev["date"] + " " + modality + "." + note, "Unpaired interviewer. Needs tester for " + modality + ".", pd.Series("Tester not assigned.", index=ev.index, dtype=object)],
+        default="Solo provider working " + modality + ".",
+    )
+    return pd.DataFrame({"Subject": subject,"Start Date": ev["date"],"Start Time": "","End Date": ev["date"],"End Time": "","All Day Event": "True","Description": desc,"Location": site})
+
+def build_findings(ev: pd.DataFrame, needs_pref: set):
+    keys = ev[["site","date","modality"]]
+    unpaired = ev["kind"] == "gap_interviewer"
+    unassigned = ev["kind"] == "gap_tester"
+    unmet = (ev["kind"] == "pair") & (ev["score"] < PREF_MET_SCORE) & ev["name"].isin(needs_pref)
+    flagged = unpaired | unmet
+    violations = keys[flagged].assign(
+        type=np.where(unpaired[flagged], "Unpaired Interviewer", "Preference Not Met"),
+        interviewer=ev["name"][flagged],
+        tester=ev["partner"].where(unmet)[flagged],
+    )
+    open_rows = unpaired | unassigned
+    gaps = keys[open_rows].assign(interviewer=ev["name"].where(unpaired)[open_rows], tester=ev["name"].where(unassigned)[open_rows])
+    return violations.reset_index(drop=True), gaps.reset_index(drop=True)
 
 def generate(roster_df: pd.DataFrame):
     df = norm_cols(roster_df)
-    mapped = df.apply(normalize_row, axis=1, result_type="expand")
+    mapped = normalize_roster(df)
     req = (mapped["site"]!="") & (mapped["date"]!="") & (mapped["modality"]!="") & (mapped["role"]!="") & (mapped["provider"]!="")
     mapped = mapped[req]
     if mapped.empty:
         raise ValueError("No valid rows after normalization. Ensure your file has Location/Employee/Start Date headers.")
 
-    events, violations, gaps = [], [], []
-    site_counts = mapped.groupby("site")["provider"].count()
-    provider_counts = mapped.groupby("provider")["site"].count()
-
-    for (site, date, modality), grp in mapped.groupby(["site","date","modality"], dropna=False):
-        interviewers = [r["provider"] for _, r in grp[grp["role"]=="interviewer"].iterrows()]
-        testers = [r["provider"] for _, r in grp[grp["role"]=="tester"].iterrows()]
-        solos = [r["provider"] for _, r in grp[grp["role"]=="solo"].iterrows()]
-        available = set(testers)
-        for i_name in interviewers:
-            best_t, best_s = None, -1
-            for t_name in list(available):
-                sc = score_pair(i_name, t_name)
-                if sc > best_s:
-                    best_s, best_t = sc, t_name
+    ev_cols = {f: [] for f in EVENT_FIELDS}
+
+    def emit(*values):
+        for f, v in zip(EVENT_FIELDS, values):
+            ev_cols[f].append(v)
+    site_counts = mapped["site"].value_counts()
+    provider_counts = mapped["provider"].value_counts()
+
+    providers = pd.Series(mapped["provider"].unique())
+    provider_lc = providers.str.lower()
+    spanish = provider_lc.str.contains(_SPANISH_RE)
+    langs = dict(zip(providers, np.where(spanish, "spanish", "english")))
+    pref_bits = preference_bits(providers, provider_lc)
+    needs_pref = set(providers[provider_lc.str.contains(_STRICT_PREF_RE) | spanish])
+
+    site_abbrev = {site: title_abbrev(site) for site in mapped["site"].unique()}
+    role_lists = {}
+    keys = zip(mapped["site"].to_numpy(dtype=object), mapped["date"].to_numpy(dtype=object), mapped["modality"].to_numpy(dtype=object))
+    for key, role, name in zip(keys, mapped["role"].to_numpy(dtype=object), mapped["provider"].to_numpy(dtype=object)):
+        lists = role_lists.get(key)
+        if lists is None:
+            lists = role_lists[key] = {r: [] for r in ROLES}
+        lists[role].append(name)
+    for (site, date, modality), lists in sorted(role_lists.items()):
+        interviewers, testers, solos = (lists[r] for r in ROLES)
+        pairs, available = pair_optimal(interviewers, testers, langs, pref_bits, needs_pref)
+        for i_name, best_t, best_s in pairs:
             if best_t:
-                available.remove(best_t)
-                desc = f"Dyad pairing for {date} {modality}."
-                if best_s >= 4: desc += " Preference satisfied."
-                elif best_s == 2: desc += " Language-matched."
-                events.append({"Subject": f"{title_abbrev(site)} | Pairing: {i_name} + {best_t}","Start Date": date,"Start Time":"","End Date": date,"End Time":"","All Day Event":"True","Description": desc,"Location": site})
-                if best_s < 4 and ("lakaii jones" in i_name.lower() or "lyn mcdonald" in i_name.lower() or lang_of(i_name)=="spanish"):
-                    violations.append({"site": site,"date": date,"modality": modality,"type":"Preference Not Met","interviewer": i_name,"tester": best_t})
+                emit("pair", site, date, modality, i_name, best_t, best_s)
             else:
-                events.append({"Subject": f"{title_abbrev(site)} | GAP: {i_name} (no tester)","Start Date": date,"Start Time":"","End Date": date,"End Time":"","All Day Event":"True","Description": f"Unpaired interviewer. Needs tester for {modality}.","Location": site})
-                gaps.append({"site": site,"date": date,"modality": modality,"interviewer": i_name})
-                violations.append({"site": site,"date": date,"modality": modality,"type":"Unpaired Interviewer","interviewer": i_name})
+                emit("gap_interviewer", site, date, modality, i_name, "", -1)
         for t_name in available:
-            events.append({"Subject": f"{title_abbrev(site)} | GAP: {t_name} (tester unassigned)","Start Date": date,"Start Time":"","End Date": date,"EndTime":"","All Day Event":"True","Description":"Tester not assigned.","Location": site})
-            gaps.append({"site": site,"date": date,"modality": modality,"tester": t_name})
+            emit("gap_tester", site, date, modality, t_name, "", -1)
         for s_name in solos:
-            events.append({"Subject": f"{title_abbrev(site)} | SOLO: {s_name}","Start Date": date,"Start Time":"","End Date": date,"End Time":"","All Day Event":"True","Description": f"Solo provider working {modality}.","Location": site})
-    return pd.DataFrame(events), pd.DataFrame(violations), pd.DataFrame(gaps), provider_counts, site_counts
+            emit("solo", site, date, modality, s_name, "", -1)
+
+    ev = pd.DataFrame(ev_cols, columns=list(EVENT_FIELDS))
+    violations, gaps = build_findings(ev, needs_pref)
+    return build_events(ev, site_abbrev), violations, gaps, provider_counts, site_counts
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def generate_cached(file_bytes: bytes, name: str):
+    return generate(load_tabular(file_bytes, name))
 
 st.title("Stonebridge Scheduler – First Working Version")
 st.caption("Upload Deputy CSV/XLSX. Auto-maps Location/Employee/Start Date, infers modality, outputs Google Calendar all-day CSV.")
@@ -159,16 +262,14 @@ st.caption("Upload Deputy CSV/XLSX. Auto-maps Location/Employee/Start Date, infe
 file = st.file_uploader("Upload Deputy roster (CSV or XLSX)", type=["csv","xlsx","xls"])
 if st.button("Run pairings", type="primary", disabled=not file) and file:
     try:
-        roster = load_tabular(file)
-        events_df, violations_df, gaps_df, provider_counts, site_counts = generate(roster)
-        csv_text = to_google_csv(events_df.to_dict(orient="records"))
+        events_df, violations_df, gaps_df, provider_counts, site_counts = generate_cached(file.getvalue(), file.name)
         fname = f"Stonebridge_Pairings_{timestamp()}.csv"
         st.success(f"Generated {len(events_df)} calendar rows.")
-        st.download_button("Download Google Calendar CSV", data=csv_text.encode("utf-8"), file_name=fname, mime="text/csv")
+        st.download_button("Download Google Calendar CSV", data=lambda: to_google_csv(events_df), file_name=fname, mime="text/csv", on_click="ignore")
         st.subheader("Summary")
         c1, c2 = st.columns(2)
         with c1: st.table(pd.DataFrame({"site": site_counts.index,"count": site_counts.values}))
-        with c2: st.table(pd.DataFrame({"provider": provider_counts.index,"count": provider_counts.values}).sort_values("count",ascending=False))
+        with c2: st.table(pd.DataFrame({"provider": provider_counts.index,"count": provider_counts.values}))
         st.subheader("Violations")
         if not violations_df.empty: st.dataframe(violations_df)
         else: st.info("No violations detected.")